@@ -24,7 +24,7 @@ export const getPatientData = tool({
     description: 'Fetch tremor or dyskinesia measurement data for a patient from Rune Labs API',
     parameters: z.object({
         patient_id: z.string().describe('The patient identifier'),
-        selected_date: z.string().describe('The end date for the data window (ISO format)'),
+        selected_date: z.string().describe('The last day of the data window, inclusive (ISO format)'),
         measurement_type: z.enum(['tremor', 'dyskinesia']).describe('Type of measurement to return'),
         repull_all: z.boolean().optional().describe('If true, ignore cache and fetch fresh data'),
         severity: z.enum(['all', 'slight', 'mild', 'moderate', 'strong', 'none', 'unknown'])
@@ -34,7 +34,7 @@ export const getPatientData = tool({
     }),
     execute: async (params: PatientDataParams) => {
         try {
-            const response = await fetch(`${PYTHON_SERVER_URL}/api/patient-data`, {
+            const response = await fetch(`${PYTHON_SERVER_URL}/api/patient-data?format=json`, {
                 method: 'POST',
                 headers: {
                     'Content-Type': 'application/json',
@@ -1,12 +1,21 @@
+import hashlib
 import json
+import os
+import functools
 import pandas as pd
 import numpy as np
 import yaml
+import shutil
+import threading
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.feather as feather
 from pathlib import Path
 from datetime import timedelta
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import logging
 
+from cachetools import TTLCache, cached
 from runeq import initialize
 from runeq.resources.stream_metadata import (
     get_patient_stream_metadata,
@@ -17,69 +26,302 @@ logger = logging.getLogger("api_data_utils")
 logger.setLevel(logging.INFO)
 
 # Constants
-KEEP_COLUMNS = [
-    "time",
-    "measurement",
-    "severity",
-    "percentage",
-    "measurement_duration_ns",
-    "device_id",
-]
 BATCH_SIZE = 10
 TMP_DIR = Path("data/api")  # Define the temporary directory path
+CACHE_DIR = TMP_DIR / "cache"
+CACHE_ROW_GROUP_SIZE = 50_000
+# Cached hours younger than this are re-fetched so late-synced data replaces them
+CACHE_REFETCH_OVERLAP = pd.Timedelta(days=2)
+CACHE_DIR.mkdir(parents=True, exist_ok=True)  # Also creates TMP_DIR
+# Leading underscore keeps the marker out of the Parquet dataset scan
+COVERAGE_FILE = "_coverage.json"
+_CACHE_SCHEMA = pa.schema(
+    [
+        ("time", pa.timestamp("ns", tz="UTC")),
+        ("percentage", pa.float64()),
+        ("year_month", pa.string()),
+    ]
+)
+PATIENT_DATA_SCHEMA = pa.schema(
+    [("time", pa.timestamp("ns", tz="UTC")), ("percentage", pa.float64())]
+)
+STREAM_METADATA_TTL = 300  # seconds
+_STREAM_IDS_CACHE = TTLCache(maxsize=1024, ttl=STREAM_METADATA_TTL)
+_STREAM_IDS_LOCK = threading.Lock()
+# Fixed pool of striped locks so per-cache locking does not grow with patients
+_CACHE_LOCKS = tuple(threading.Lock() for _ in range(64))
+
+
+@functools.lru_cache(maxsize=1)
+def _load_api_config():
+    """Load the API section of data_config.yaml once per process."""
+    config_path = Path("data_config.yaml")
+    if not config_path.exists():
+        logger.warning(
+            "Configuration file data_config.yaml not found, using default values."
+        )
+        return {
+            "algorithm": "ingest-strive-applewatch-md.0",
+            "device_id": "all",
+            "stream_type_id": "percentage",
+        }
+    with config_path.open("r") as f:
+        config = yaml.safe_load(f)
+    return config.get("api", {})
+
+
+@cached(_STREAM_IDS_CACHE, lock=_STREAM_IDS_LOCK)
+def _get_stream_ids(
+    patient_id, algorithm, device_id, stream_type_id, measurement, severity
+):
+    """Return the stream ids matching the metadata filters, memoized for STREAM_METADATA_TTL."""
+    metadata = get_patient_stream_metadata(
+        patient_id=patient_id,
+        algorithm=algorithm,
+        device_id=device_id,
+        stream_type_id=stream_type_id,
+        measurement=measurement,
+        severity=severity,
+    )
+    return tuple(metadata.ids())
+
+
+def clear_stream_metadata_cache():
+    """Drop memoized stream metadata so the next request re-queries the API."""
+    with _STREAM_IDS_LOCK:
+        _STREAM_IDS_CACHE.clear()
+
 
+def _ensure_utc(s):
+    """Localize naive datetimes to UTC, or convert tz-aware ones, without re-parsing."""
+    return s.dt.tz_localize("UTC") if s.dt.tz is None else s.dt.tz_convert("UTC")
 
-def safe_concat_dataframes(dfs):
-    """Safely concatenate DataFrames, handling empty lists."""
-    if not dfs:
-        return pd.DataFrame(columns=KEEP_COLUMNS)
-    return pd.concat(dfs, ignore_index=True)
+
+def _cache_lock(cache_dir):
+    """Return the lock that serializes fetching into and reading one patient cache."""
+    return _CACHE_LOCKS[hash(cache_dir) % len(_CACHE_LOCKS)]
+
+
+def _cache_config_key(algorithm, device_id, stream_type_id):
+    """Key the cache by the data_config.yaml settings that decide which streams are read."""
+    config = f"{algorithm}|{device_id}|{stream_type_id}"
+    return hashlib.sha1(config.encode("utf-8")).hexdigest()[:12]
+
+
+def _open_cache(cache_dir):
+    """Open a patient cache as a Parquet dataset partitioned by year_month."""
+    return ds.dataset(cache_dir, format="parquet", partitioning="hive")
+
+
+def _read_coverage(cache_dir):
+    """Return the (start, end) range the cache is known to hold, or None if unknown."""
+    coverage_path = cache_dir / COVERAGE_FILE
+    if not coverage_path.exists():
+        return None
+    with coverage_path.open("r") as f:
+        coverage = json.load(f)
+    return pd.Timestamp(coverage["start"]), pd.Timestamp(coverage["end"])
+
+
+def _write_coverage(cache_dir, start, end):
+    """Atomically record the range the cache holds, including stretches with no data."""
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    tmp_path = cache_dir / f"{COVERAGE_FILE}.tmp"
+    with tmp_path.open("w") as f:
+        json.dump({"start": start.isoformat(), "end": end.isoformat()}, f)
+    os.replace(tmp_path, cache_dir / COVERAGE_FILE)
+
+
+def _read_cache(cache_dir, lower_bound, window_end):
+    """Read cached rows in [lower_bound, window_end) as an Arrow table, pruning row groups."""
+    if not cache_dir.exists():
+        return PATIENT_DATA_SCHEMA.empty_table()
+    dataset = _open_cache(cache_dir)
+    if not dataset.files:
+        return PATIENT_DATA_SCHEMA.empty_table()
+    # The year_month bounds let the scan skip whole partitions without opening them;
+    # "%Y-%m" strings sort chronologically.
+    return dataset.to_table(
+        columns=["time", "percentage"],
+        filter=(ds.field("year_month") >= lower_bound.strftime("%Y-%m"))
+        & (
+            ds.field("year_month")
+            <= (window_end - pd.Timedelta(1)).strftime("%Y-%m")
+        )
+        & (ds.field("time") >= lower_bound)
+        & (ds.field("time") < window_end),
+    )
+
+
+def _write_cache(cache_dir, new_data_df):
+    """
+    Merge freshly fetched rows into the cache; new rows replace cached ones at the same time.
+    Only the year_month partitions touched by the new rows are rewritten.
+    """
+    if new_data_df.empty:
+        return
+    new_data_df = new_data_df.assign(
+        year_month=new_data_df["time"].dt.strftime("%Y-%m")
+    )
+    if cache_dir.exists() and _open_cache(cache_dir).files:
+        touched_months = pa.array(new_data_df["year_month"].unique())
+        cached_df = (
+            _open_cache(cache_dir)
+            .to_table(
+                columns=["time", "percentage", "year_month"],
+                filter=ds.field("year_month").isin(touched_months),
+            )
+            .to_pandas()
+        )
+        # Compare UTC timestamps as int64 keys. Cached rows can only collide with
+        # new ones from the start of the new fetch on.
+        cached_keys = cached_df["time"].values.view("i8")
+        new_keys = new_data_df["time"].values.view("i8")
+        duplicated = cached_keys >= new_keys.min()
+        duplicated[duplicated] = np.isin(cached_keys[duplicated], new_keys)
+        cached_df = cached_df[~duplicated]
+        new_data_df = pd.concat(
+            [cached_df, new_data_df], ignore_index=True, copy=False, sort=False
+        )
+    table = (
+        pa.Table.from_pandas(new_data_df, preserve_index=False)
+        .cast(_CACHE_SCHEMA)
+        .sort_by("time")
+    )
+    # delete_matching removes a partition before rewriting it, so a crash mid-write
+    # can lose cached rows. Dropping the coverage marker first makes the next
+    # call re-fetch the window instead of trusting the hole.
+    (cache_dir / COVERAGE_FILE).unlink(missing_ok=True)
+    ds.write_dataset(
+        table,
+        cache_dir,
+        format="parquet",
+        partitioning=["year_month"],
+        partitioning_flavor="hive",
+        existing_data_behavior="delete_matching",
+        file_options=ds.ParquetFileFormat().make_write_options(compression="zstd"),
+        max_rows_per_group=CACHE_ROW_GROUP_SIZE,
+    )
+
+
+def _merge_uncached(
+    cache_dir, new_data_df, fetch_start, fetch_end, lower_bound, window_end
+):
+    """Overlay freshly fetched rows on the cached window without writing the cache."""
+    cached_df = _read_cache(cache_dir, lower_bound, window_end).to_pandas()
+    fetched = cached_df["time"] >= fetch_start
+    if fetch_end is not None:
+        fetched &= cached_df["time"] < fetch_end
+    frames = [cached_df[~fetched]]
+    if new_data_df is not None:
+        in_window = (new_data_df["time"] >= lower_bound) & (
+            new_data_df["time"] < window_end
+        )
+        frames.append(new_data_df[in_window])
+    merged = pd.concat(frames, ignore_index=True, sort=False)
+    return merged.sort_values("time", ignore_index=True)
+
+
+def _fetch_hourly(stream_ids, fetch_start, fetch_end, measurement_type, severity):
+    """
+    Fetch [fetch_start, fetch_end) for all streams in parallel batches and average it
+    per hour. fetch_end=None fetches up to now.
+
+    Returns the hourly frame (None if there was no data) and the number of failed batches.
+    """
+    # Split stream_ids into batches.
+    batches = [
+        stream_ids[i : i + BATCH_SIZE] for i in range(0, len(stream_ids), BATCH_SIZE)
+    ]
+
+    column_batches = []
+    failed_batches = 0
+    with ThreadPoolExecutor(max_workers=min(32, len(batches))) as executor:
+        future_to_batch = {
+            executor.submit(
+                fetch_stream_batch,
+                batch,
+                fetch_start,
+                measurement_type,
+                severity,
+                end_time=fetch_end,
+            ): batch
+            for batch in batches
+        }
+        for future in as_completed(future_to_batch):
+            try:
+                batch_columns = future.result()
+                if batch_columns is not None and len(batch_columns["time"]):
+                    column_batches.append(batch_columns)
+            except Exception as e:
+                failed_batches += 1
+                logger.error(f"Error fetching stream batch: {e}")
+
+    if failed_batches:
+        logger.warning(f"{failed_batches} of {len(batches)} stream batches failed")
+    if not column_batches:
+        return None, failed_batches
+
+    # Stack each column once and build the frame in one shot
+    new_data_df = pd.DataFrame(
+        {
+            "time": pd.DatetimeIndex(
+                np.concatenate([b["time"] for b in column_batches])
+            ).tz_localize("UTC"),
+            "percentage": np.concatenate([b["percentage"] for b in column_batches]),
+        },
+        copy=False,
+    )
+
+    # Resample to hourly averages across all batches
+    new_data_df = (
+        new_data_df.groupby(pd.Grouper(key="time", freq="1h"))["percentage"]
+        .mean()
+        .reset_index()
+    )
+
+    # Drop rows where percentage is NaN
+    return new_data_df[new_data_df["percentage"].notna()], failed_batches
 
 
 def fetch_stream_batch(
-    stream_ids, start_time, measurement_type="tremor", severity="all"
+    stream_ids, start_time, measurement_type="tremor", severity="all", end_time=None
 ):
     """
-    Fetch data for a batch of streams and resample to hourly averages.
+    Fetch raw time and percentage data for a batch of streams as a dict of numpy arrays.
 
     Args:
         stream_ids: List of stream IDs to fetch
         start_time: Start time for the data window
         measurement_type: Type of measurement (not used for filtering as handled in metadata)
         severity: Severity level (not used for filtering as handled in metadata)
-    """
-    try:
-        df = get_stream_dataframe(
-            stream_ids=stream_ids,
-            start_time=start_time,
-        )
-
-        if df is not None and not df.empty:
-            logger.info(f"Initial data shape: {df.shape}")
+        end_time: Exclusive end of the data window, or None for up to now
 
-            # Convert time to datetime if it isn't already
-            df["time"] = pd.to_datetime(df["time"])
+    Returns None when the batch has no data. API errors are raised rather than
+    swallowed, so the caller can tell a failed batch from an empty one.
+    """
+    df = get_stream_dataframe(
+        stream_ids=stream_ids,
+        start_time=start_time,
+        end_time=end_time,
+    )
 
-            # Keep all required columns
-            df = df[["time", "percentage"]]
+    if df is not None and not df.empty:
+        logger.info(f"Initial data shape: {df.shape}")
 
-            # Resample to hourly averages
-            df = (
-                df.set_index("time")
-                .resample("1h")
-                .agg(
-                    {
-                        "percentage": "mean",
-                    }
-                )
-                .reset_index()
-            )
+        # Parse time only if the API did not already return datetimes
+        if pd.api.types.is_datetime64_any_dtype(df["time"]):
+            df["time"] = _ensure_utc(df["time"])
+        else:
+            df["time"] = pd.to_datetime(df["time"], utc=True)
 
-            return df
-        return None
-    except Exception as e:
-        logger.error(f"Error fetching stream batch: {e}")
-        return None
+        # Keep all required columns as plain arrays; time is UTC datetime64[ns]
+        # and hourly resampling happens once after stacking
+        return {
+            "time": df["time"].values,
+            "percentage": df["percentage"].to_numpy(dtype="float64"),
+        }
+    return None
 
 
 def get_api_data(
@@ -91,11 +333,12 @@ def get_api_data(
 ) -> pd.DataFrame:
     """
     Fetch tremor or dyskinesia data for a given patient from the API, returning data only for the
-    one-month window ending on the selected_date. Caching is used to avoid redundant API calls.
+    one-month window ending on the selected_date. The whole selected day is included.
+    Caching is used to avoid redundant API calls.
 
     Parameters:
       - patient_id (str): The patient identifier.
-      - selected_date (datetime.date or datetime.datetime): The end date for the data window.
+      - selected_date (datetime.date or datetime.datetime): The last day of the data window.
       - measurement_type (str): Type of measurement (used in metadata filtering)
       - repull_all (bool): If True, the cache is ignored and data is re-fetched.
       - severity (str): Severity level (used in metadata filtering)
@@ -104,93 +347,121 @@ def get_api_data(
       - pd.DataFrame: DataFrame containing the requested measurement data with columns:
         [time, percentage]
     """
-    # Load API configuration.
-    config_path = Path("data_config.yaml")
-    if not config_path.exists():
-        logger.warning(
-            "Configuration file data_config.yaml not found, using default values."
-        )
-        config = {
-            "api": {
-                "algorithm": "ingest-strive-applewatch-md.0",
-                "device_id": "all",
-                "stream_type_id": "percentage",
-            }
-        }
-    else:
-        with config_path.open("r") as f:
-            config = yaml.safe_load(f)
+    # patient_id comes from the request, so it must be a single plain path component
+    if patient_id in ("", ".", "..") or any(
+        sep in patient_id for sep in ("/", "\\", "\0")
+    ):
+        raise ValueError(f"Invalid patient_id: {patient_id!r}")
+    patient_dir = CACHE_DIR / patient_id
 
-    api_config = config.get("api", {})
+    api_config = _load_api_config()
     algorithm = api_config.get("algorithm", "ingest-strive-applewatch-md.0")
     device_id = api_config.get("device_id", "all")
     stream_type_id = api_config.get("stream_type_id", "percentage")
+    cache_dir = (
+        patient_dir
+        / _cache_config_key(algorithm, device_id, stream_type_id)
+        / f"{measurement_type}_{severity}"
+    )
 
     # Get stream metadata using the API, filtering is handled at metadata level
-    metadata = get_patient_stream_metadata(
-        patient_id=patient_id,
-        algorithm=algorithm,
-        device_id=device_id,
-        stream_type_id=stream_type_id,
-        measurement=measurement_type,
-        severity=severity,
+    stream_ids = list(
+        _get_stream_ids(
+            patient_id,
+            algorithm,
+            device_id,
+            stream_type_id,
+            measurement_type,
+            severity,
+        )
     )
-    stream_ids = list(metadata.ids())
     if not stream_ids:
         logger.info(
             f"No streams found for patient {patient_id} with measurement type {measurement_type}."
         )
-        return pd.DataFrame(columns=["time", "percentage"])
+        return PATIENT_DATA_SCHEMA.empty_table().to_pandas()
 
     # Define the time window: one month ending at selected_date.
-    upper_bound = pd.Timestamp(selected_date).tz_localize("UTC")
+    upper_bound = pd.Timestamp(selected_date)
+    upper_bound = (
+        upper_bound.tz_localize("UTC")
+        if upper_bound.tz is None
+        else upper_bound.tz_convert("UTC")
+    )
     lower_bound = upper_bound - pd.Timedelta(days=30)
+    window_end = upper_bound.normalize() + pd.Timedelta(days=1)
 
-    # Split stream_ids into batches.
-    batches = np.array_split(
-        np.array(stream_ids), np.ceil(len(stream_ids) / BATCH_SIZE)
-    )
+    # The coverage marker records the contiguous range already fetched into the
+    # cache, so only the missing head of the window, or the tail since the last
+    # fetch plus an overlap for data that is synced late, has to be fetched.
+    # Concurrent requests for the same cache wait here and reuse the first one's fetch.
+    with _cache_lock(cache_dir):
+        if repull_all and cache_dir.exists():
+            shutil.rmtree(cache_dir)
 
-    dfs = []
-    with ThreadPoolExecutor() as executor:
-        future_to_batch = {
-            executor.submit(
-                fetch_stream_batch,
-                batch.tolist(),
-                lower_bound,  # Use lower_bound as start_time
-                measurement_type,
-                severity,
-            ): batch
-            for batch in batches
-        }
-        for future in future_to_batch:
-            try:
-                df_batch = future.result()
-                if df_batch is not None and not df_batch.empty:
-                    dfs.append(df_batch)
-            except Exception as e:
-                logger.error(f"Error fetching batch for patient {patient_id}: {e}")
+        window_start = lower_bound.floor("1h")
+        coverage = _read_coverage(cache_dir)
+        if coverage is None:
+            fetch_start, fetch_end = window_start, None
+        else:
+            covered_start, covered_end = coverage
+            refetch_from = (covered_end - CACHE_REFETCH_OVERLAP).floor("1h")
+            needs_head = window_start < covered_start
+            needs_tail = window_end > refetch_from
+            if needs_head and needs_tail:
+                fetch_start, fetch_end = window_start, None
+            elif needs_head:
+                fetch_start, fetch_end = window_start, covered_start
+            elif needs_tail:
+                fetch_start, fetch_end = refetch_from, None
+            else:
+                fetch_start = None
 
-    if not dfs:
-        return pd.DataFrame(columns=["time", "percentage"])
+        if fetch_start is not None:
+            fetched_at = pd.Timestamp.now(tz="UTC")
+            new_data_df, failed_batches = _fetch_hourly(
+                stream_ids, fetch_start, fetch_end, measurement_type, severity
+            )
 
-    # Combine all dataframes
-    final_df = safe_concat_dataframes(dfs)
+            if failed_batches:
+                # Hourly means from a partial fetch are wrong and would never be
+                # re-fetched, so serve them for this request without caching them.
+                logger.warning(
+                    f"Fetch for patient {patient_id} was incomplete; returning uncached data"
+                )
+                return _merge_uncached(
+                    cache_dir,
+                    new_data_df,
+                    fetch_start,
+                    fetch_end,
+                    lower_bound,
+                    window_end,
+                )
 
-    # Ensure correct column order
-    final_df = final_df[["time", "percentage"]]
+            if new_data_df is not None:
+                _write_cache(cache_dir, new_data_df)
+            # Recorded last, once the partitions are written; empty stretches count too
+            if coverage is None:
+                _write_coverage(cache_dir, fetch_start, fetched_at)
+            else:
+                _write_coverage(
+                    cache_dir,
+                    min(covered_start, fetch_start),
+                    covered_end if fetch_end is not None else fetched_at,
+                )
 
-    # Drop rows where percentage is NaN
-    final_df = final_df[final_df["percentage"].notna()]
+        table = _read_cache(cache_dir, lower_bound, window_end)
+    final_df = table.to_pandas()
 
-    # Save DataFrame as feather file
-    if not final_df.empty:
-        TMP_DIR.mkdir(parents=True, exist_ok=True)
+    # Save the response as a feather file for debugging, only when asked to
+    # Read per call: main.py imports this module before load_dotenv() runs
+    debug_dump = os.getenv("DEBUG_DUMP_FEATHER", "").lower() in ("1", "true", "yes")
+    if debug_dump and table.num_rows:
         tmp_path = (
             TMP_DIR
             / f"tmp_data_{measurement_type}_{pd.Timestamp.now().strftime('%Y%m%d_%H%M%S')}.feather"
         )
-        final_df.to_feather(tmp_path)
+        feather.write_feather(table, tmp_path, compression="uncompressed")
         logger.info(f"Saved temporary data to: {tmp_path}")
 
     return final_df
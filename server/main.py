@@ -1,14 +1,27 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Query, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel, validator
+from starlette.concurrency import run_in_threadpool
 from datetime import datetime
 import logging
-from typing import Optional, List, Dict, Any
+from typing import Optional, Any, Literal
 import os
 from dotenv import load_dotenv
+import orjson
+import pandas as pd
+import pyarrow as pa
+import pyarrow.ipc as ipc
 
 from runeq import initialize
-from api_data_utils import get_api_data
+from api_data_utils import (
+    PATIENT_DATA_SCHEMA,
+    clear_stream_metadata_cache,
+    get_api_data,
+)
+
+# Copy-on-Write turns filtered/sliced frames into lazy views instead of copies
+pd.options.mode.copy_on_write = True
 
 # Load environment variables
 load_dotenv()
@@ -17,7 +30,26 @@ load_dotenv()
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = FastAPI(title="Rune Labs Data API")
+
+def _orjson_default(obj):
+    """Serialize values orjson does not handle natively"""
+    if isinstance(obj, pd.Timestamp):
+        return obj.to_pydatetime()
+    raise TypeError(f"Type is not JSON serializable: {type(obj).__name__}")
+
+
+class PandasORJSONResponse(ORJSONResponse):
+    """ORJSONResponse that also serializes pandas timestamps and numpy values"""
+
+    def render(self, content: Any) -> bytes:
+        return orjson.dumps(
+            content,
+            default=_orjson_default,
+            option=orjson.OPT_SERIALIZE_NUMPY,
+        )
+
+
+app = FastAPI(title="Rune Labs Data API", default_response_class=PandasORJSONResponse)
 
 # Configure CORS
 app.add_middleware(
@@ -62,6 +94,19 @@ class ErrorResponse(BaseModel):
     detail: str
 
 
+ARROW_STREAM_MEDIA_TYPE = "application/vnd.apache.arrow.stream"
+
+
+def dataframe_to_arrow_stream(df: pd.DataFrame) -> bytes:
+    """Serialize a DataFrame as an Arrow IPC stream"""
+    # A fixed schema keeps column types in the stream even when df is empty
+    table = pa.Table.from_pandas(df, schema=PATIENT_DATA_SCHEMA, preserve_index=False)
+    sink = pa.BufferOutputStream()
+    with ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+
 @app.on_event("startup")
 async def startup_event():
     """Initialize Rune Labs SDK on startup"""
@@ -79,10 +124,43 @@ async def health_check():
     return {"status": "healthy"}
 
 
-@app.post("/api/patient-data", response_model=Dict[str, List[Dict[str, Any]]])
-async def get_patient_data_endpoint(request: PatientDataRequest):
+@app.post("/api/admin/clear-metadata-cache")
+async def clear_metadata_cache():
+    """Flush memoized stream metadata so the next request pulls it fresh"""
+    clear_stream_metadata_cache()
+    logger.info("Stream metadata cache cleared")
+    return {"status": "cleared"}
+
+
+@app.post(
+    "/api/patient-data",
+    response_model=None,
+    responses={
+        200: {
+            "description": "Arrow IPC stream by default, JSON records with ?format=json",
+            "content": {
+                ARROW_STREAM_MEDIA_TYPE: {},
+                "application/json": {
+                    "schema": {
+                        "type": "object",
+                        "properties": {
+                            "data": {"type": "array", "items": {"type": "object"}}
+                        },
+                    }
+                },
+            },
+        }
+    },
+)
+async def get_patient_data_endpoint(
+    request: PatientDataRequest,
+    format: Literal["arrow", "json"] = Query("arrow"),
+):
     """
     Fetch patient measurement data from Rune Labs API
+
+    The data is returned as an Arrow IPC stream by default; pass ?format=json
+    for the {"data": [records]} JSON payload.
     """
     try:
         logger.info(f"Fetching data for patient {request.patient_id}")
@@ -92,8 +170,9 @@ async def get_patient_data_endpoint(request: PatientDataRequest):
             request.selected_date.replace("Z", "+00:00")
         )
 
-        # Get data using the existing function
-        data = get_api_data(
+        # get_api_data blocks on network and disk I/O, so keep it off the event loop
+        data = await run_in_threadpool(
+            get_api_data,
             patient_id=request.patient_id,
             selected_date=selected_date,
             measurement_type=request.measurement_type,
@@ -101,11 +180,16 @@ async def get_patient_data_endpoint(request: PatientDataRequest):
             severity=request.severity,
         )
 
-        # Convert DataFrame to dict
-        result = {"data": data.to_dict(orient="records")}
-        logger.info(f"Successfully fetched {len(result['data'])} records")
+        logger.info(f"Successfully fetched {len(data)} records")
+
+        if format == "arrow":
+            return Response(
+                content=dataframe_to_arrow_stream(data),
+                media_type=ARROW_STREAM_MEDIA_TYPE,
+            )
 
-        return result
+        # Returning the response directly skips FastAPI's jsonable_encoder pass
+        return PandasORJSONResponse({"data": data.to_dict(orient="records")})
 
     except ValueError as e:
         logger.error(f"Validation error: {str(e)}")
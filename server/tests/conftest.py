@@ -0,0 +1,30 @@
+import sys
+import types
+from pathlib import Path
+
+# Tests import the server modules the same way main.py does
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+try:
+    import runeq  # noqa: F401
+except ImportError:
+    # The tests replace every runeq call, so only the import names have to exist
+
+    def _not_stubbed(*args, **kwargs):
+        raise NotImplementedError("runeq is not installed; patch this call in the test")
+
+    runeq = types.ModuleType("runeq")
+    runeq.initialize = _not_stubbed
+    resources = types.ModuleType("runeq.resources")
+    stream_metadata = types.ModuleType("runeq.resources.stream_metadata")
+    stream_metadata.get_patient_stream_metadata = _not_stubbed
+    stream_metadata.get_stream_dataframe = _not_stubbed
+    runeq.resources = resources
+    resources.stream_metadata = stream_metadata
+    sys.modules.update(
+        {
+            "runeq": runeq,
+            "runeq.resources": resources,
+            "runeq.resources.stream_metadata": stream_metadata,
+        }
+    )
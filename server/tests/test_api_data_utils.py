@@ -0,0 +1,151 @@
+import datetime
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import api_data_utils
+
+
+class FakeStreamMetadata:
+    def __init__(self, ids):
+        self._ids = ids
+
+    def ids(self):
+        return iter(self._ids)
+
+
+class FakeRune:
+    """Serves one 10-minute sample per stream between data_start and data_end."""
+
+    def __init__(self):
+        self.stream_ids = [f"s{i}" for i in range(12)]  # two fetch batches
+        self.data_start = pd.Timestamp("2023-01-01", tz="UTC")
+        self.data_end = pd.Timestamp("2024-03-10", tz="UTC")
+        self.value = 10.0
+        self.failing_stream = None
+        self.calls = []
+
+    def get_patient_stream_metadata(self, **filters):
+        return FakeStreamMetadata(self.stream_ids)
+
+    def get_stream_dataframe(self, stream_ids, start_time, end_time=None):
+        self.calls.append((start_time, end_time))
+        if self.failing_stream in stream_ids:
+            raise RuntimeError("503 Service Unavailable")
+        start = max(start_time, self.data_start)
+        end = self.data_end if end_time is None else min(end_time, self.data_end)
+        times = pd.date_range(start, end, freq="10min", inclusive="left")
+        return pd.DataFrame(
+            {
+                "time": np.repeat(times.values, len(stream_ids)),
+                "percentage": self.value,
+            }
+        )
+
+    def fetch_starts(self):
+        return sorted({start for start, _ in self.calls})
+
+
+@pytest.fixture
+def rune(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(api_data_utils, "TMP_DIR", tmp_path)
+    monkeypatch.setattr(api_data_utils, "CACHE_DIR", tmp_path / "cache")
+    api_data_utils.clear_stream_metadata_cache()
+    fake = FakeRune()
+    monkeypatch.setattr(
+        api_data_utils, "get_patient_stream_metadata", fake.get_patient_stream_metadata
+    )
+    monkeypatch.setattr(
+        api_data_utils, "get_stream_dataframe", fake.get_stream_dataframe
+    )
+    return fake
+
+
+def coverage_path():
+    return next(api_data_utils.CACHE_DIR.rglob(api_data_utils.COVERAGE_FILE), None)
+
+
+def test_cache_miss_fetches_and_hit_does_not(rune):
+    first = api_data_utils.get_api_data("p1", datetime.date(2024, 3, 1))
+    assert len(rune.calls) == 2
+    assert len(first) == 31 * 24
+    assert (first["percentage"] == 10.0).all()
+
+    rune.calls.clear()
+    second = api_data_utils.get_api_data("p1", datetime.date(2024, 3, 1))
+    assert rune.calls == []
+    pd.testing.assert_frame_equal(first, second)
+
+
+def test_earlier_window_fetches_only_the_missing_head(rune):
+    api_data_utils.get_api_data("p1", datetime.date(2024, 3, 1))
+    rune.calls.clear()
+
+    df = api_data_utils.get_api_data("p1", datetime.date(2024, 2, 20))
+    head_start = pd.Timestamp("2024-01-21", tz="UTC")
+    assert rune.calls == [(head_start, pd.Timestamp("2024-01-31", tz="UTC"))] * 2
+    assert df["time"].min() == head_start
+    assert not df["time"].duplicated().any()
+
+
+def test_recent_hours_are_refetched_and_replaced(rune):
+    now = pd.Timestamp.now(tz="UTC")
+    rune.data_end = now
+    api_data_utils.get_api_data("p1", now.date())
+
+    rune.value = 20.0
+    rune.calls.clear()
+    df = api_data_utils.get_api_data("p1", now.date())
+
+    refetch_from = rune.fetch_starts()[0]
+    assert now - pd.Timedelta(days=3) < refetch_from < now - pd.Timedelta(days=1)
+    assert not df["time"].duplicated().any()
+    recent = df["time"] >= refetch_from
+    assert (df.loc[recent, "percentage"] == 20.0).all()
+    assert (df.loc[~recent, "percentage"] == 10.0).all()
+
+
+def test_failed_batch_is_returned_but_not_cached(rune):
+    rune.failing_stream = "s0"
+    partial = api_data_utils.get_api_data("p1", datetime.date(2024, 3, 1))
+    assert len(partial) == 31 * 24
+    assert coverage_path() is None
+    assert not list(api_data_utils.CACHE_DIR.rglob("*.parquet"))
+
+    rune.failing_stream = None
+    rune.calls.clear()
+    api_data_utils.get_api_data("p1", datetime.date(2024, 3, 1))
+    assert len(rune.calls) == 2
+    assert coverage_path() is not None
+
+
+def test_window_starting_before_the_first_data_is_not_refetched(rune):
+    rune.data_start = pd.Timestamp("2024-02-01", tz="UTC")
+    for _ in range(3):
+        df = api_data_utils.get_api_data("p1", datetime.date(2024, 2, 15))
+    # One fetch of two batches; the empty head is remembered as covered
+    assert rune.calls == [(pd.Timestamp("2024-01-16", tz="UTC"), None)] * 2
+    assert df["time"].min() == rune.data_start
+
+
+def test_selected_day_is_included(rune):
+    df = api_data_utils.get_api_data("p1", datetime.date(2024, 3, 1))
+    assert df["time"].min() == pd.Timestamp("2024-01-31 00:00", tz="UTC")
+    assert df["time"].max() == pd.Timestamp("2024-03-01 23:00", tz="UTC")
+
+
+@pytest.mark.parametrize("patient_id", ["", ".", "..", "p1/../p2", "p1\\p2"])
+def test_path_like_patient_ids_are_rejected(rune, patient_id):
+    with pytest.raises(ValueError):
+        api_data_utils.get_api_data(patient_id, datetime.date(2024, 3, 1))
+    assert rune.calls == []
+
+
+def test_patient_without_streams_gets_typed_empty_frame(rune):
+    rune.stream_ids = []
+    df = api_data_utils.get_api_data("p1", datetime.date(2024, 3, 1))
+    assert df.empty
+    assert str(df["time"].dtype) == "datetime64[ns, UTC]"
+    assert df["percentage"].dtype == "float64"
@@ -0,0 +1,20 @@
+import pandas as pd
+import pyarrow as pa
+import pyarrow.ipc as ipc
+import pytest
+
+from api_data_utils import PATIENT_DATA_SCHEMA
+from main import dataframe_to_arrow_stream
+
+
+@pytest.mark.parametrize(
+    "df",
+    [
+        PATIENT_DATA_SCHEMA.empty_table().to_pandas(),
+        pd.DataFrame(columns=["time", "percentage"]),
+    ],
+)
+def test_empty_arrow_stream_keeps_column_types(df):
+    table = ipc.open_stream(pa.py_buffer(dataframe_to_arrow_stream(df))).read_all()
+    assert table.num_rows == 0
+    assert table.schema.equals(PATIENT_DATA_SCHEMA)